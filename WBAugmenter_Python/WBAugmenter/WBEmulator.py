@@ -14,41 +14,65 @@
 
 
 import numpy as np
-import numpy.matlib
 import cv2
+from numba import njit, prange, get_num_threads, set_num_threads
 import random as rnd
 import os
 import shutil
+import multiprocessing
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 class WBEmulator:
-  def __init__(self):
+  _params = None  # model parameters, loaded once and shared by all instances
+
+  def __init__(self, writer_threads=4):
+    params = WBEmulator._load_params()
     # training encoded features
-    self.features = np.load('params/features.npy')
+    self.features = params['features']
+    # squared norms of the training features (fixed at load time)
+    self.features_sqnorm = params['features_sqnorm']
     # mapping functions to emulate WB effects
-    self.mappingFuncs = np.load('params/mappingFuncs.npy')
+    self.mappingFuncs = params['mappingFuncs']
     # weight matrix for histogram encoding
-    self.encoderWeights = np.load('params/encoderWeights.npy')
+    self.encoderWeights = params['encoderWeights']
     # bias vector for histogram encoding
-    self.encoderBias = np.load('params/encoderBias.npy')
+    self.encoderBias = params['encoderBias']
     self.h = 60  # histogram bin width
     self.K = 25  # K value for nearest neighbor searching
     self.sigma = 0.25  # fall off factor for KNN
+    self._inv_two_sigma_sq = 0.5 / self.sigma ** 2  # 1 / (2 * sigma^2)
     # WB & photo finishing styles
     self.wb_photo_finishing = ['_F_AS', '_F_CS', '_S_AS', '_S_CS',
                                '_T_AS', '_T_CS', '_C_AS', '_C_CS',
                                '_D_AS', '_D_CS']
+    # background threads that encode and save output images (images are
+    # saved right away if writer_threads is 0)
+    self._writer = (ThreadPoolExecutor(max_workers=writer_threads)
+                    if writer_threads > 0 else None)
+    self._pending_writes = []
+
+  @staticmethod
+  def _load_params():
+    """Loads the model parameters on first use and returns the cached ones
+        afterwards. The files are memory-mapped, so arrays that are already
+        float32 are paged in lazily and shared through the OS page cache."""
+    if WBEmulator._params is None:
+      params = {}
+      for name in ['features', 'mappingFuncs', 'encoderWeights',
+                   'encoderBias']:
+        params[name] = np.load('params/' + name + '.npy',
+                               mmap_mode='r').astype(np.float32, copy=False)
+      params['features_sqnorm'] = np.einsum('ij,ij->i', params['features'],
+                                            params['features'])[:, None]
+      WBEmulator._params = params
+    return WBEmulator._params
 
   def encode(self, hist):
     """Generates a compacted feature of a given RGB-uv histogram tensor."""
-    histR_reshaped = np.reshape(np.transpose(hist[:, :, 0]),
-                                (1, int(hist.size / 3)), order="F")
-    histG_reshaped = np.reshape(np.transpose(hist[:, :, 1]),
-                                (1, int(hist.size / 3)), order="F")
-    histB_reshaped = np.reshape(np.transpose(hist[:, :, 2]),
-                                (1, int(hist.size / 3)), order="F")
-    hist_reshaped = np.append(histR_reshaped,
-                              [histG_reshaped, histB_reshaped])
+    # the R, G and B layers, one after another (a view of hist)
+    hist_reshaped = np.reshape(hist, (1, hist.size))
     feature = np.dot(hist_reshaped - self.encoderBias.transpose(),
                      self.encoderWeights)
     return feature
@@ -61,31 +85,20 @@ class WBEmulator:
       newH = int(np.floor(sz[0] * factor))
       newW = int(np.floor(sz[1] * factor))
       I = cv2.resize(I, (newW, newH), interpolation=cv2.INTER_NEAREST)
-    I_reshaped = I[(I > 0).all(axis=2)]
+    # pixels with a zero channel are skipped inside _build_hist
+    I_reshaped = np.reshape(I, (-1, 3))
     eps = 6.4 / self.h
-    A = np.arange(-3.2, 3.19, eps)  # dummy vector
-    hist = np.zeros((A.size, A.size, 3))  # histogram will be stored here
-    Iy = np.linalg.norm(I_reshaped, axis=1)  # intensity vector
-    for i in range(3):  # for each histogram layer, do
-      r = []  # excluded channels will be stored here
-      for j in range(3):  # for each color channel do
-        if j != i:  # if current channel does not match current layer,
-          r.append(j)  # exclude it
-      Iu = np.log(I_reshaped[:, i] / I_reshaped[:, r[1]])
-      Iv = np.log(I_reshaped[:, i] / I_reshaped[:, r[0]])
-      hist[:, :, i], _, _ = np.histogram2d(
-        Iu, Iv, bins=self.h, range=((-3.2 - eps / 2, 3.2 - eps / 2),) * 2,
-        weights=Iy)
-      norm_ = hist[:, :, i].sum()
-      hist[:, :, i] = np.sqrt(hist[:, :, i] / norm_)  # (hist/norm)^(1/2)
+    # histogram layers are stored along the first axis (R, G, B)
+    hist = _build_hist(I_reshaped, self.h, eps, get_num_threads())
+    norm_ = hist.sum(axis=(1, 2), keepdims=True)
+    hist = np.sqrt(hist / norm_).astype(np.float32)  # (hist/norm)^(1/2)
     return hist
 
   def generateWbsRGB(self, I, outNum=10):
     """Generates outNum new images of a given image I."""
     assert (outNum <= 10)
-    I = cv2.cvtColor(I, cv2.COLOR_BGR2RGB)  # convert from BGR to RGB
-    I = im2double(I)  # convert to double
-    feature = self.encode(self.rgbuv_hist(I))
+    I = im2double(I)  # convert to double (the image is kept in BGR)
+    feature = self.encode(self.rgbuv_hist(I[:, :, ::-1]))  # RGB view
     if outNum < len(self.wb_photo_finishing):
       wb_pf = rnd.sample(self.wb_photo_finishing, outNum)
       inds = []
@@ -95,73 +108,60 @@ class WBEmulator:
     else:
       wb_pf = self.wb_photo_finishing
       inds = list(range(0, len(wb_pf)))
-    synthWBimages = np.zeros((I.shape[0], I.shape[1],
-                              I.shape[2], len(wb_pf)))
 
-    D_sq = np.einsum('ij, ij ->i', self.features,
-                     self.features)[:, None] + np.einsum(
-      'ij, ij ->i', feature, feature) - 2 * self.features.dot(feature.T)
+    D_sq = (self.features_sqnorm + np.dot(feature, feature.T) -
+            2.0 * np.dot(self.features, feature.T))
 
     # get smallest K distances
     idH = D_sq.argpartition(self.K, axis=0)[:self.K]
-    dH = np.sqrt(
-      np.take_along_axis(D_sq, idH, axis=0))
-    weightsH = np.exp(-(np.power(dH, 2)) /
-                      (2 * np.power(self.sigma, 2)))  # compute weights
-    weightsH = weightsH / sum(weightsH)  # normalize blending weights
-    for i in range(len(inds)):  # for each of the retried training examples,
-      ind = inds[i]  # for each WB & PF style,
-      # generate a mapping function
-      mf = sum(np.reshape(np.matlib.repmat(weightsH, 1, 27),
-                          (self.K, 1, 9, 3)) *
-               self.mappingFuncs[(idH - 1) * 10 + ind, :])
-      mf = mf.reshape(9, 3, order="F")  # reshape it to be 9 * 3
-      synthWBimages[:, :, :, i] = changeWB(I, mf)  # apply it!
+    dH_sq = np.take_along_axis(D_sq, idH, axis=0)  # squared distances
+    weightsH = np.exp(-dH_sq * self._inv_two_sigma_sq)  # compute weights
+    weightsH /= weightsH.sum()  # normalize blending weights
+    # indices of the mapping functions of the K retrieved training examples
+    # for each WB & PF style (K * outNum)
+    idx = (idH.reshape(self.K, 1) - 1) * 10 + np.asarray(inds).reshape(1, -1)
+    # gather them all at once (K * outNum * 9 * 3) and blend them
+    mf_block = self.mappingFuncs[idx]
+    mfs = np.einsum('k,ksjl->sjl', weightsH[:, 0], mf_block, optimize=True)
+    # the mapping functions work on RGB; permute them to work on BGR pixels,
+    # whose kernel terms are (b, g, r, b2, g2, r2, bg, br, gr)
+    mfs = mfs[:, [2, 1, 0, 5, 4, 3, 8, 7, 6], ::-1]
+    synthWBimages = apply_wbs_fused(I, mfs)  # apply them all at once!
     return synthWBimages, wb_pf
 
   def single_image_processing(self, in_img, out_dir="../results", outNum=10,
                               write_original=1):
     """Applies the WB emulator to a single image in_img."""
     assert (outNum <= 10)
-    print("processing image: " + in_img + "\n")
-    filename, file_extension = os.path.splitext(in_img)  # get file parts
-    I = cv2.imread(in_img)  # read the image
-    # generate new images with different WB settings
-    outImgs, wb_pf = self.generateWbsRGB(I, outNum)
-    for i in range(outNum):  # save images
-      outImg = outImgs[:, :, :, i]  # get the ith output image
-      cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                  wb_pf[i] + file_extension, outImg * 255)  # save it
-      if write_original == 1:
-        cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                    '_original' + file_extension, I)
+    self._process_image(in_img, out_dir, outNum, write_original)
+    self._flush_writes()
 
   def batch_processing(self, in_dir, out_dir="../results", outNum=10,
-                       write_original=1):
-    """Applies the WB emulator to all images in a given directory in_dir."""
+                       write_original=1, workers=1):
+    """Applies the WB emulator to all images in a given directory in_dir.
+
+    Images are processed in this process if workers is 1, or else in a pool
+    of workers processes (one per CPU if workers is None). The pool spawns
+    new processes, so the calling script must guard its top-level code with
+    if __name__ == "__main__":.
+    """
     assert (outNum <= 10)
     imgfiles = []
     valid_images = (".jpg", ".bmp", ".png", ".tga")
     for f in os.listdir(in_dir):
       if f.lower().endswith(valid_images):
         imgfiles.append(os.path.join(in_dir, f))
-    for in_img in imgfiles:
-      print("processing image: " + in_img + "\n")
-      filename, file_extension = os.path.splitext(in_img)
-      I = cv2.imread(in_img)
-      outImgs, wb_pf = self.generateWbsRGB(I, outNum)
-      for i in range(outNum):  # save images
-        outImg = outImgs[:, :, :, i]  # get the ith output image
-        cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                    wb_pf[i] + file_extension, outImg * 255)  # save it
-        if write_original == 1:
-          cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                      '_original' + file_extension, I)
+    self._process_images([(in_img, out_dir, outNum, write_original)
+                          for in_img in imgfiles], workers)
 
   def trainingGT_processing(self, in_dir, out_dir, gt_dir, out_gt_dir, gt_ext,
-                            outNum=10, write_original=1):
+                            outNum=10, write_original=1, workers=1):
     """Applies the WB emulator to all training images in in_dir and
-        generates corresponding GT files"""
+        generates corresponding GT files
+
+    workers works as in batch_processing; a value other than 1 needs the
+    if __name__ == "__main__": guard in the calling script.
+    """
     imgfiles = []  # image files will be saved here
     gtfiles = []  # ground truth files will be saved here
     # valid image file extensions (modify it if needed)
@@ -176,59 +176,230 @@ class WBEmulator:
       gtfiles.append(os.path.join(gt_dir, os.path.basename(filename) +
                                   gt_ext))
 
-    for in_img, gtfile in zip(imgfiles, gtfiles):
-      print("processing image: " + in_img + "\n")
-      filename, file_extension = os.path.splitext(in_img)
+    self._process_images([(in_img, out_dir, outNum, write_original, gtfile,
+                           out_gt_dir)
+                          for in_img, gtfile in zip(imgfiles, gtfiles)],
+                         workers)
+
+  def _process_images(self, jobs, workers):
+    """Calls _process_image with each argument tuple in jobs, in this process
+        if workers is 1, or else in a pool of worker processes."""
+    if workers == 1:
+      for job in jobs:
+        self._process_image(*job)
+      self._flush_writes()
+    else:  # images are independent, so process them in parallel
+      with _worker_pool(workers) as ex:
+        list(ex.map(_process_one, jobs))
+
+  def _process_image(self, in_img, out_dir, outNum, write_original,
+                     gtfile=None, out_gt_dir=None):
+    """Generates and saves outNum new images of the image file in_img. If
+        gtfile is given, it is copied to out_gt_dir for each new image."""
+    print("processing image: " + in_img + "\n")
+    filename, file_extension = os.path.splitext(in_img)  # get file parts
+    if gtfile is not None:
       gtbasename, gt_extension = os.path.splitext(gtfile)
       gtbasename = os.path.basename(gtbasename)
-      I = cv2.imread(in_img)
-      # generate new images with different WB settings
-      outImgs, wb_pf = self.generateWbsRGB(I, outNum)
-      for i in range(outNum):
-        outImg = outImgs[:, :, :, i]
-        cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                    wb_pf[i] + file_extension, outImg * 255)  # save it
+    I = cv2.imread(in_img)  # read the image
+    # generate new images with different WB settings
+    outImgs, wb_pf = self.generateWbsRGB(I, outNum)
+    # the previous image was being saved meanwhile; wait for it, so that at
+    # most one image's writes are queued at a time
+    self._flush_writes()
+    scratch = np.empty(outImgs.shape[:3], dtype=outImgs.dtype)
+    for i in range(outNum):  # save images
+      outImg = outImgs[:, :, :, i]  # get the ith output image
+      img_u8 = im2uint8(outImg, scratch)
+      self._imwrite(out_dir + '/' + os.path.basename(filename) +
+                    wb_pf[i] + file_extension, img_u8)  # save it
+      if gtfile is not None:
         shutil.copyfile(gtfile,  # copy corresponding gt file
                         os.path.join(out_gt_dir, gtbasename + wb_pf[i] +
                                      gt_extension))
 
-        if write_original == 1:  # if write_original flag is true
-          cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                      '_original' + file_extension, I)
-          # copy corresponding gt file
-          shutil.copyfile(gtfile, os.path.join(
-            out_gt_dir, gtbasename + '_original' + gt_extension))
+    if write_original == 1:  # if write_original flag is true
+      self._imwrite(out_dir + '/' + os.path.basename(filename) +
+                    '_original' + file_extension, I)
+      if gtfile is not None:
+        # copy corresponding gt file
+        shutil.copyfile(gtfile, os.path.join(
+          out_gt_dir, gtbasename + '_original' + gt_extension))
+
+  def _imwrite(self, filename, img):
+    """Queues img to be saved as filename by the background writer threads,
+        or saves it right away if there are none."""
+    if self._writer is None:
+      cv2.imwrite(filename, img)
+      return
+    self._pending_writes.append(self._writer.submit(cv2.imwrite, filename,
+                                                    img))
+
+  def _flush_writes(self):
+    """Waits until all queued images have been saved."""
+    for future in self._pending_writes:
+      future.result()  # re-raises any error of the write
+    self._pending_writes = []
+
+
+_worker_emulator = None  # WB emulator of the current worker process
+# environment variables that set the thread count of the BLAS library
+_BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'MKL_NUM_THREADS']
+
+
+@contextlib.contextmanager
+def _worker_pool(workers=None):
+  """Yields a process pool for batch processing, with workers single-threaded
+     worker processes (one per CPU if workers is None). Workers are spawned
+     rather than forked, as forking after the Numba thread pool has started
+     can deadlock the workers."""
+  # BLAS reads its thread count when numpy is imported, so it must be set in
+  # the environment the workers are spawned with
+  saved = {var: os.environ.get(var) for var in _BLAS_THREAD_VARS}
+  os.environ.update({var: '1' for var in _BLAS_THREAD_VARS})
+  try:
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker) as ex:
+      yield ex
+  finally:
+    for var, value in saved.items():  # restore the parent's environment
+      if value is None:
+        del os.environ[var]
+      else:
+        os.environ[var] = value
+
+
+def _init_worker():
+  """Creates the WB emulator of a batch processing worker. The pool already
+     keeps the cores busy, so Numba and OpenCV use a single thread in each
+     worker, and images are saved without background writer threads."""
+  global _worker_emulator
+  set_num_threads(1)
+  cv2.setNumThreads(1)
+  _worker_emulator = WBEmulator(writer_threads=0)
+
+
+def _process_one(args):
+  """Processes a single image in a batch processing worker."""
+  _worker_emulator._process_image(*args)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _build_hist(I, h, eps, n_chunks):
+  """Accumulates the (u, v) log-chroma histogram of each layer in one pass."""
+  N = I.shape[0]
+  lo = -3.2 - eps / 2  # lower edge of the first bin
+  inv = 1.0 / eps
+  # each chunk of pixels has its own buffer, so no atomics are needed
+  local = np.zeros((n_chunks, 3, h, h))
+  step = (N + n_chunks - 1) // n_chunks
+  for c in prange(n_chunks):
+    for n in range(c * step, min(N, (c + 1) * step)):
+      r = I[n, 0]
+      g = I[n, 1]
+      b = I[n, 2]
+      if r <= 0 or g <= 0 or b <= 0:  # log-chroma is undefined, skip it
+        continue
+      Iy = np.sqrt(r * r + g * g + b * b)  # intensity
+      # log(a / b) = log(a) - log(b), so three logs serve all layers
+      logI = (np.log(r), np.log(g), np.log(b))
+      for i in range(3):  # for each histogram layer, do
+        # u uses the second excluded channel and v the first one
+        u_ch = 1 if i == 2 else 2
+        v_ch = 1 if i == 0 else 0
+        tu = (logI[i] - logI[u_ch] - lo) * inv
+        tv = (logI[i] - logI[v_ch] - lo) * inv
+        if 0 <= tu < h and 0 <= tv < h:
+          local[c, i, int(tu), int(tv)] += Iy
+  return local.sum(axis=0)
 
 
 def changeWB(input, m):
   """Applies a mapping function m to a given input image."""
   sz = np.shape(input)  # get size of input image
-  I_reshaped = np.reshape(input, (int(input.size / 3), 3),
-                          order="F")
+  I_reshaped = np.reshape(input, (int(input.size / 3), 3))  # no-copy view
   kernel_out = kernelP9(I_reshaped)  # raise input image to a higher-dim space
   # apply m to the input image after raising it the selected higher degree
   out = np.dot(kernel_out, m)
   out = outOfGamutClipping(out)  # clip out-of-gamut pixels
   # reshape output image back to the original image shape
-  out = out.reshape(sz[0], sz[1], sz[2], order="F")
+  out = out.reshape(sz[0], sz[1], sz[2])
   out = cv2.cvtColor(out.astype('float32'), cv2.COLOR_RGB2BGR)
   return out
 
 
+def apply_wbs_fused(input, mfs):
+  """Applies a stack of mapping functions mfs (S * 9 * 3) to a given input
+     image. Each pixel is raised to the kernelP9 space, mapped by all mapping
+     functions and clipped in a single pass, without storing the kernel
+     output.
+
+  No color conversion is done, so the output images have the channel order
+  of the input image. Returns the S output images stacked along the last
+  axis.
+  """
+  sz = np.shape(input)  # get size of input image
+  S = mfs.shape[0]
+  # (9, 3 * S) block whose column S * c + s is channel c of style s
+  m_big = np.ascontiguousarray(
+    np.reshape(np.transpose(mfs, (1, 2, 0)), (9, 3 * S)), dtype=input.dtype)
+  out = np.empty((sz[0], sz[1], sz[2], S), dtype=input.dtype)
+  _apply_mapping(np.reshape(input, (-1, 3)), m_big,
+                 np.reshape(out, (-1, 3 * S)))  # no-copy view
+  return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _apply_mapping(I, m, out):
+  """Computes clip(kernelP9(I) * m) one pixel at a time, into out."""
+  for n in prange(I.shape[0]):
+    c0 = I[n, 0]
+    c1 = I[n, 1]
+    c2 = I[n, 2]
+    # kernelP9 terms of the current pixel
+    k = (c0, c1, c2, c0 * c0, c1 * c1, c2 * c2, c0 * c1, c0 * c2, c1 * c2)
+    for j in range(m.shape[1]):
+      v = (k[0] * m[0, j] + k[1] * m[1, j] + k[2] * m[2, j] +
+           k[3] * m[3, j] + k[4] * m[4, j] + k[5] * m[5, j] +
+           k[6] * m[6, j] + k[7] * m[7, j] + k[8] * m[8, j])
+      out[n, j] = min(max(v, 0.0), 1.0)  # clip out-of-gamut pixels
+
+
 def kernelP9(I):
   """Kernel function: kernel(r, g, b) -> (r, g, b, r2, g2, b2, rg, rb, gb)"""
-  return (np.transpose((I[:, 0], I[:, 1], I[:, 2], I[:, 0] * I[:, 0],
-                        I[:, 1] * I[:, 1], I[:, 2] * I[:, 2], I[:, 0] * I[:, 1],
-                        I[:, 0] * I[:, 2], I[:, 1] * I[:, 2])))
+  out = np.empty((I.shape[0], 9), dtype=I.dtype)
+  r, g, b = I[:, 0], I[:, 1], I[:, 2]
+  out[:, 0:3] = I
+  np.multiply(r, r, out=out[:, 3])
+  np.multiply(g, g, out=out[:, 4])
+  np.multiply(b, b, out=out[:, 5])
+  np.multiply(r, g, out=out[:, 6])
+  np.multiply(r, b, out=out[:, 7])
+  np.multiply(g, b, out=out[:, 8])
+  return out
 
 
 def outOfGamutClipping(I):
   """Clips out-of-gamut pixels."""
-  I[I > 1] = 1  # any pixel is higher than 1, clip it to 1
-  I[I < 0] = 0  # any pixel is below 0, clip it to 0
+  np.clip(I, 0, 1, out=I)  # clip to [0, 1] in place
   return I
 
 
 def im2double(im):
   """Returns a double image [0,1] of the uint8 im [0,255]."""
-  return cv2.normalize(im.astype('float'), None, 0.0, 1.0, cv2.NORM_MINMAX)
+  return im.astype(np.float32, copy=False) * np.float32(1.0 / 255.0)
+
+
+def im2uint8(im, scratch=None):
+  """Returns a uint8 image [0,255] of the double im [0,1].
+
+  im must already be clipped to [0,1]. scratch is an optional float buffer of
+  the same shape as im, reused for the scaled values.
+  """
+  scratch = np.multiply(im, 255, out=scratch)
+  out = np.empty(im.shape, dtype=np.uint8)
+  # round to nearest, as cv2 does when converting to uint8
+  np.rint(scratch, out=out, casting='unsafe')
+  return out
@@ -27,7 +27,8 @@ outImgs, wb_pf = wbColorAug.generateWbsRGB(I, outNum)
 for i in range(outNum):  # save images
     outImg = outImgs[:, :, :, i]  # get the ith output image
     cv2.imwrite(out_dir + '/' + os.path.basename(filename) +
-                '_' + wb_pf[i] + file_extension, outImg * 255)  # save it
+                '_' + wb_pf[i] + file_extension,
+                wbAug.im2uint8(outImg))  # save it
 
 
 
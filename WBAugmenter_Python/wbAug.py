@@ -32,6 +32,8 @@ def parse_args():
     p("--ground_truth_dir", help="Ground truth directory")
     p("--out_ground_truth_dir", help="Output directory for ground truth files")
     p("--ground_truth_ext", help="File extension of ground truth files")
+    p("--workers", type=int, default=os.cpu_count(),
+      help="Number of worker processes for batch processing")
     return parser.parse_args()
 
 def main():
@@ -48,13 +50,14 @@ def main():
                                          args.ground_truth_dir,
                                          args.out_ground_truth_dir,
                                          args.ground_truth_ext, args.out_number,
-                                         args.write_original)
+                                         args.write_original, args.workers)
     elif args.input_image_dir is not None:
         if args.out_dir is None:
             args.out_dir = "../results"
         os.makedirs(args.out_dir, exist_ok=True)
         wbColorAug.batch_processing(args.input_image_dir, args.out_dir,
-                                    args.out_number, args.write_original)
+                                    args.out_number, args.write_original,
+                                    args.workers)
     else:  # process a single image
         if args.out_dir is None:
             args.out_dir = "../results"